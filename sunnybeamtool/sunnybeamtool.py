@@ -3,15 +3,17 @@
 import asyncio
 import logging
 import struct
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-import crcmod
 from usb import core, util
 
 _LOGGER = logging.getLogger(__name__)
 
 from .const import (
     BASIC_MSG,
+    FCS_TABLE,
     GET_LAST_MONTH_CMD,
     GET_MEASUREMENTS_CMD,
     GET_TODAY_CMD,
@@ -19,13 +21,120 @@ from .const import (
     SYN_ONLINE_CMD,
 )
 
+# Little-endian layouts of the message fields
+_MEASUREMENTS = struct.Struct("<fff")
+_UINT16 = struct.Struct("<H")
+_UINT32 = struct.Struct("<I")
+_RECORD = struct.Struct("<i4xf")  # timestamp, 4 unknown bytes, value
+
+
+class _LazyHex:
+    """Hex representation of a buffer that is only built when a log record is emitted
+
+    Only wrap buffers that are not modified afterwards, handlers may format later.
+    """
+
+    __slots__ = ("_data",)
+
+    def __init__(self, data: bytes | bytearray | memoryview):
+        self._data = data
+
+    def __str__(self) -> str:
+        return self._data.hex()
+
+
+def _fcs(
+    data: bytes | bytearray | memoryview, table: tuple[int, ...] = FCS_TABLE
+) -> int:
+    """Calculate the X-25 frame check sequence
+
+    Args:
+        data (bytes | bytearray | memoryview): unescaped data
+        table (tuple[int, ...], optional): lookup table. Defaults to FCS_TABLE.
+
+    Returns:
+        int: frame check sequence
+    """
+    fcs = 0xFFFF
+    for b in data:
+        fcs = (fcs >> 8) ^ table[(fcs ^ b) & 0xFF]
+    return fcs ^ 0xFFFF
+
+
+def _escaped_fcs(data: bytes | bytearray, table: tuple[int, ...] = FCS_TABLE) -> int:
+    """Calculate the X-25 frame check sequence of escaped data in a single pass
+
+    Args:
+        data (bytes | bytearray): escaped data
+        table (tuple[int, ...], optional): lookup table. Defaults to FCS_TABLE.
+
+    Returns:
+        int: frame check sequence of the unescaped data
+    """
+    fcs = 0xFFFF
+    it = iter(data)
+    for b in it:
+        if b == 0x7D:
+            escaped = next(it, None)
+            if escaped is None:
+                break
+            b = escaped ^ 0x20
+        fcs = (fcs >> 8) ^ table[(fcs ^ b) & 0xFF]
+    return fcs ^ 0xFFFF
+
+
+def _unescape(data: bytes) -> bytearray:
+    """Remove the byte stuffing from a frame
+
+    Plain runs between 0x7d escapes are copied in one go, so only the escapes
+    themselves are handled byte by byte.
+
+    Args:
+        data (bytes): escaped data
+
+    Returns:
+        bytearray: unescaped data
+    """
+    view = memoryview(data)
+    out = bytearray()
+    cursor = 0
+    escape = data.find(0x7D)
+    while escape >= 0:
+        out += view[cursor:escape]
+        cursor = escape + 1
+        if cursor < len(data) and data[cursor] != 0x7D:
+            out.append(data[cursor] ^ 0x20)
+            cursor += 1
+        escape = data.find(0x7D, cursor)
+    out += view[cursor:]
+    return out
+
+
+def _decode_frame(frame: bytes) -> bytearray:
+    """Remove the stutter bytes and the byte stuffing from a received frame
+
+    Args:
+        frame (bytes): raw 0x7e...0x7e frame as read from the device
+
+    Returns:
+        bytearray: unescaped frame including both 0x7e delimiters
+    """
+    # long communications get a 0x01 0x60 in between. not sure why...
+    return _unescape(frame.replace(b"\x01\x60", b""))
+
 
 class SunnyBeam:
     """Sunny Beam connection"""
 
     def __init__(self):
-        self._crc_function = crcmod.predefined.mkCrcFun("x-25")
         self._dev = None
+        self._endpoint_in = None
+        self._endpoint_out = None
+        # pyusb is not reentrant per device, so all USB calls share one worker
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # two reusable bulk read buffers: the queued next read fills one while the
+        # payload of the previous read is still copied out of the other
+        self._read_buffers = (array("B", bytes(1024)), array("B", bytes(1024)))
         self._device_id: bytearray | None = None
         self._connected = False
 
@@ -70,13 +179,14 @@ class SunnyBeam:
             await self._do_syn_online()
             await self._send_raw_message(GET_MEASUREMENTS_CMD, True)
 
-            buf = await self._read_raw_message(50)
+            buf = await self._read_raw_message(4.0)
             if len(buf) <= 0:
                 raise ConnectionError("Device does not respond")
 
-            power = int(struct.unpack("f", buf[25:29])[0])
-            energy_today = round(struct.unpack("f", buf[29:33])[0], 3)
-            energy_total = round(struct.unpack("f", buf[33:37])[0], 3)
+            power, energy_today, energy_total = _MEASUREMENTS.unpack_from(buf, 25)
+            power = int(power)
+            energy_today = round(energy_today, 3)
+            energy_total = round(energy_total, 3)
 
             _LOGGER.debug("pac: %d W", power)
             _LOGGER.debug("e-today: %f kWh", energy_today)
@@ -131,14 +241,14 @@ class SunnyBeam:
         # Find SMA device
         loop = asyncio.get_event_loop()
         dev = await loop.run_in_executor(
-            None, lambda: core.find(idVendor=0x1587, idProduct=0x002D)
+            self._executor, lambda: core.find(idVendor=0x1587, idProduct=0x002D)
         )
         if dev is None:
             raise ConnectionError("Sunny Beam not found")
 
         # Reset device and activate first available configuration
-        await loop.run_in_executor(None, dev.reset)
-        await loop.run_in_executor(None, dev.set_configuration)
+        await loop.run_in_executor(self._executor, dev.reset)
+        await loop.run_in_executor(self._executor, dev.set_configuration)
         self._dev = dev
         _LOGGER.info(
             "Connected to %s from %s with serial number %s",
@@ -146,12 +256,24 @@ class SunnyBeam:
             self._dev.manufacturer,
             self._dev.serial_number,
         )
-        await loop.run_in_executor(None, lambda: util.claim_interface(self._dev, 0))
+        await loop.run_in_executor(
+            self._executor, lambda: util.claim_interface(self._dev, 0)
+        )
+
+        # Resolve the bulk endpoints once instead of on every transfer
+        config = await loop.run_in_executor(
+            self._executor, self._dev.get_active_configuration
+        )
+        interface = config[(0, 0)]
+        self._endpoint_out = util.find_descriptor(interface, bEndpointAddress=0x02)
+        self._endpoint_in = util.find_descriptor(interface, bEndpointAddress=0x81)
+        if self._endpoint_out is None or self._endpoint_in is None:
+            raise ConnectionError("Sunny Beam endpoints not found")
 
         # First do a SET_FEATURE config
         try:
             response = await loop.run_in_executor(
-                None,
+                self._executor,
                 lambda: self._dev.ctrl_transfer(
                     bmRequestType=0x40, bRequest=0x03, wIndex=0x0000, wValue=0x4138
                 ),
@@ -164,21 +286,18 @@ class SunnyBeam:
         # Fetching device ID
         if self._device_id is None:
             self._device_id = await self._search_device_id()
-            _LOGGER.debug(
-                "device id= "
-                + hex(self._device_id[1]).lstrip("0x")
-                + hex(self._device_id[0]).lstrip("0x")
-            )
+            _LOGGER.debug("device id= %x%x", self._device_id[1], self._device_id[0])
         await asyncio.sleep(0.7)
         self._connected = True
 
-    async def _do_combined_read_messages(self, input_msg: bytearray) -> bytearray:
+    async def _do_combined_read_messages(self, input_msg: bytes) -> bytearray:
 
         # first message
         await self._do_syn_online()
         await self._send_raw_message(input_msg, True)
 
         buf_out = bytearray()
+        next_msg = bytearray(NEXT_MSG_CMD)
         minimum = 20
         linecnt = 0xFF
         while linecnt != 0:
@@ -187,9 +306,9 @@ class SunnyBeam:
                 break
             if linecnt != 0xFF:
                 # ask next messages
-                NEXT_MSG_CMD[10] = linecnt
-                await self._send_raw_message(NEXT_MSG_CMD, True)
-            tmpbuf = await self._read_raw_message(50)
+                next_msg[10] = linecnt
+                await self._send_raw_message(next_msg, True)
+            tmpbuf = await self._read_raw_message(4.0)
             if len(tmpbuf) <= 0:
                 return buf_out
 
@@ -198,7 +317,7 @@ class SunnyBeam:
                 buf_out.extend(tmpbuf[12:-3])
             linecnt = tmpbuf[10]
 
-        _LOGGER.debug("Read multiple msgs: %s", buf_out.hex())
+        _LOGGER.debug("Read multiple msgs: %s", _LazyHex(buf_out))
         return buf_out
 
     def _parse_measurements(
@@ -216,25 +335,28 @@ class SunnyBeam:
         if rawdata is None or len(rawdata) <= 0:
             return None
 
-        data = []
-        for i in range(5, len(rawdata), 12):
-            part_buf = rawdata[i : i + 12]
-            _LOGGER.debug("day: %s", part_buf.hex())
+        records = memoryview(rawdata)[5:]
+        if len(records) % _RECORD.size != 0:
+            return None
 
-            if len(part_buf) != 12:
-                return None
-            val = round(struct.unpack("f", part_buf[8:])[0], 0)
-            timestamp = struct.unpack("i", part_buf[0:4])[0]
-            time = datetime.fromtimestamp(timestamp)
-            data.append((time, val))
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            for i in range(0, len(records), _RECORD.size):
+                _LOGGER.debug("day: %s", records[i : i + _RECORD.size].hex())
 
-        return list(reversed(data))
+        data = [
+            (datetime.fromtimestamp(timestamp), round(val, 0))
+            for timestamp, val in _RECORD.iter_unpack(records)
+        ]
+        data.reverse()
+        return data
 
-    async def _send_raw_message(self, msg: bytearray, set_device_id: bool) -> int:
+    async def _send_raw_message(
+        self, msg: bytes | bytearray, set_device_id: bool
+    ) -> int:
         """Sends a raw message and returns the number of bytes written
 
         Args:
-            msg (bytearray): _description_
+            msg (bytes | bytearray): message template, copied before it is completed
             set_device_id (bool): _description_
 
         Raises:
@@ -243,42 +365,24 @@ class SunnyBeam:
         Returns:
             int: Number of bytes written
         """
+        frame = bytearray(msg)
         if set_device_id:
-            msg[7:9] = self._device_id
-
-        msg_for_crc = bytearray()
-        escape_next = False
-        for b in msg[1:-3]:
-            if b == 0x7D:
-                escape_next = True
-            else:
-                if escape_next:
-                    b ^= 0x20
-                    escape_next = False
-                msg_for_crc.append(b)
-
-        # Add CRC
-        crc = self._crc_function(msg_for_crc)
-        checksum = bytearray(crc.to_bytes(length=2, byteorder="little"))
-        new_crc = bytearray()
-        for value in checksum:
-            if value == 0x7E:
-                new_crc.append(0x7D)
-                new_crc.append(0x5E)
-            elif value == 0x7D:
-                new_crc.append(0x7D)
-                new_crc.append(0x5D)
-            else:
-                new_crc.append(value)
-        msg[-3:-1] = new_crc
-
-        _LOGGER.debug("Sent: %s", msg.hex())
+            frame[7:9] = self._device_id
+
+        # Add CRC, escaping 0x7d before 0x7e so inserted escapes are not doubled
+        crc = _escaped_fcs(frame[1:-3])
+        checksum = _UINT16.pack(crc)
+        frame[-3:-1] = checksum.replace(b"\x7d", b"\x7d\x5d").replace(
+            b"\x7e", b"\x7d\x5e"
+        )
+
+        _LOGGER.debug("Sent: %s", _LazyHex(frame))
         await asyncio.sleep(0.2)
 
         try:
             loop = asyncio.get_event_loop()
             nr_sent_bytes = await loop.run_in_executor(
-                None, lambda: self._dev.write(endpoint=0x02, data=msg, timeout=1000)
+                self._executor, self._endpoint_out.write, frame, 1000
             )
         except core.USBError as err:
             raise ConnectionError("Device not available") from err
@@ -286,86 +390,91 @@ class SunnyBeam:
             raise ConnectionError("Could not send raw message to device")
         return nr_sent_bytes
 
-    async def _read_raw_message(
-        self, max_iterations: int, buffer_size: int = 1024
-    ) -> bytearray:
+    async def _read_raw_message(self, timeout: float) -> bytearray:
         """Read raw message from device
 
         Args:
-            max_iterations (int): number of iterations to wait for a response (each 70ms)
-            buffer_size (int, optional): buffer size. Defaults to 1024.
+            timeout (float): time in seconds to wait for a complete response
 
         Returns:
             bytearray: raw response message
         """
-        buf_out = bytearray()
+        raw = bytearray()
         # reading can spawn multiple 'usb_bulk_read operations
         # always ignore the first two raw bytes and seek for "0x7e...0x7e sequence
-        start_found = False
-        previous_char_is_escape = False
-
-        await asyncio.sleep(0.3)
-
-        for _ in range(max_iterations):
-            await asyncio.sleep(0.07)
-            try:
-                loop = asyncio.get_event_loop()
-                raw_response = await loop.run_in_executor(
-                    None,
-                    lambda: self._dev.read(
-                        endpoint=0x81, size_or_buffer=buffer_size, timeout=1000
-                    ),
-                )
-            except core.USBError as err:
-                raise ConnectionError("Could not read form device") from err
-            buf_in = bytearray(raw_response.tobytes())
-            _LOGGER.debug("raw_read: %s", buf_in.hex())
-
-            # Process payload if available
-            if len(buf_in) > 2:
-                end_found = False
-
-                for p in range(2, len(buf_in)):
-                    my_byte = buf_in[p]
-
-                    if my_byte == 0x7E:
-                        if not start_found:
-                            start_found = True
-                        else:
-                            end_found = True
-
-                    # long communications get a 0x01 0x60 in between. not sure why...
-                    if start_found and (my_byte == 0x60) and (buf_in[p - 1] == 0x01):
-                        del buf_out[-1]
-                        continue
-
-                    if my_byte == 0x7D:
-                        previous_char_is_escape = True
-                        continue
-
-                    if previous_char_is_escape:
-                        if my_byte == 0x5E:
-                            my_byte = 0x7E  # not end!
-                        elif my_byte == 0x5D:
-                            my_byte = 0x7D  # not and escape char!
-                        else:
-                            my_byte ^= 0x20
-                        previous_char_is_escape = False
-
-                    buf_out.append(my_byte)
-                    if end_found:
-                        break  # stop payload processing
-
-                if end_found:
-                    break  # stop iterations
-
-        _LOGGER.debug("raw_read processed: %s", buf_out.hex())
+        start = end = -1
+        loop = asyncio.get_event_loop()
+
+        def bulk_read(buffer: array) -> int:
+            return self._endpoint_in.read(buffer, timeout=50)
+
+        async def read_frame() -> None:
+            nonlocal start, end
+            delay = 0.001
+            index = 0
+            pending = loop.run_in_executor(
+                self._executor, bulk_read, self._read_buffers[index]
+            )
+            while end < 0:
+                buf_in = memoryview(self._read_buffers[index])
+                timed_out = False
+                try:
+                    buf_in = buf_in[: await pending]
+                except core.USBTimeoutError:
+                    buf_in = buf_in[:0]
+                    timed_out = True
+                except core.USBError as err:
+                    raise ConnectionError("Could not read form device") from err
+
+                if len(buf_in) > 2:
+                    # Queue the next bulk read into the other buffer before this one
+                    # is handled, so the transfer overlaps with the processing below
+                    index ^= 1
+                    pending = loop.run_in_executor(
+                        self._executor, bulk_read, self._read_buffers[index]
+                    )
+                if _LOGGER.isEnabledFor(logging.DEBUG):
+                    _LOGGER.debug("raw_read: %s", buf_in.hex())
+
+                # Collect payload if available and only search the new bytes for 0x7e
+                if len(buf_in) > 2:
+                    delay = 0.001
+                    offset = len(raw)
+                    raw.extend(buf_in[2:])
+                    if start < 0:
+                        start = raw.find(0x7E, offset)
+                        offset = start + 1
+                    if start >= 0:
+                        end = raw.find(0x7E, offset)
+                    if end >= 0:
+                        # Frame is complete, drop the read queued above
+                        pending.cancel()
+                else:
+                    if not timed_out:
+                        # Idle reads return only the two status bytes, back off
+                        # before polling again. A timeout already waited 50 ms.
+                        await asyncio.sleep(delay)
+                        delay = min(delay * 2, 0.05)
+                    pending = loop.run_in_executor(
+                        self._executor, bulk_read, self._read_buffers[index]
+                    )
+
+        try:
+            await asyncio.wait_for(read_frame(), timeout)
+        except asyncio.TimeoutError:
+            _LOGGER.debug("raw_read timed out after %.1f s", timeout)
+
+        if start < 0:
+            buf_out = bytearray()
+        elif end < 0:
+            buf_out = _decode_frame(bytes(memoryview(raw)[start:]))
+        else:
+            buf_out = _decode_frame(bytes(memoryview(raw)[start : end + 1]))
+        _LOGGER.debug("raw_read processed: %s", _LazyHex(buf_out))
 
         # Check CRC
         if len(buf_out) > 2:
-            crc = bytearray(
-                self._crc_function(buf_out[1:-3]).to_bytes(length=2, byteorder="little")
-            )
+            crc = _UINT16.pack(_fcs(memoryview(buf_out)[1:-3]))
             msg_crc = buf_out[-3:-1]
             if crc != msg_crc:
                 _LOGGER.warning(
@@ -387,12 +496,11 @@ class SunnyBeam:
 
         # Integrate serial number in request
         serial_number_prepared = int(self._dev.serial_number) + 140000000
-        BASIC_MSG[12:16] = bytearray(
-            serial_number_prepared.to_bytes(length=4, byteorder="little")
-        )
+        msg = bytearray(BASIC_MSG)
+        _UINT32.pack_into(msg, 12, serial_number_prepared)
 
-        await self._send_raw_message(BASIC_MSG, False)
-        data = await self._read_raw_message(20)
+        await self._send_raw_message(msg, False)
+        data = await self._read_raw_message(2.0)
         if len(data) < 7:
             raise ConnectionError("Device does not respond")
         return data[5:7]
@@ -404,4 +512,4 @@ class SunnyBeam:
             ConnectionError: raised if connection is not available or device does not respond
         """
         await self._send_raw_message(SYN_ONLINE_CMD, False)
-        await self._read_raw_message(5)  # always read dummy data
+        await self._read_raw_message(0.7)  # always read dummy data